@@ -1,14 +1,142 @@
 """
 JVDデータベースからのデータ抽出モジュール
 """
+import os
+import time
+import uuid
+import hashlib
 import pandas as pd
 import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
-from .database import get_engine, get_session
+from sqlalchemy.engine import make_url
+from .database import get_connection_string, read_sql, read_sql_params
 
 logger = logging.getLogger(__name__)
 
-def extract_race_base_data(year_from=2010, year_to=2023, chunksize=None):
+# 抽出時にカテゴリ型へ変換する高カーディナリティの文字列キー
+_CATEGORY_COLUMNS = [
+    'ketto_toroku_bango', 'kishu_code', 'chokyoshi_code',
+    'keibajo_code', 'bamei', 'kishumei_ryakusho'
+]
+
+# 抽出時にダウンキャストする数値カラムの型（値域に合わせた最小の型）
+# 整数は欠損を保持できるnullable型とし、'**'などの数値でない値は0ではなく欠損にする
+_DOWNCAST_SCHEMA = {
+    'barei': 'UInt8', 'umaban': 'UInt8', 'kakutei_chakujun': 'UInt8',
+    'corner_01_tsuka_juni': 'UInt8', 'corner_02_tsuka_juni': 'UInt8',
+    'corner_03_tsuka_juni': 'UInt8', 'corner_04_tsuka_juni': 'UInt8',
+    'shusso_tosu': 'UInt8', 'tansho_ninkijun': 'UInt8',
+    'tansho_odds': 'float32', 'soha_time': 'float32', 'kohan_3f': 'float32',
+    'bataiju': 'UInt16', 'zogen_sa': 'Int16', 'kyori': 'UInt16'
+}
+
+# ダウンキャスト先の型（Polars）
+_POLARS_DTYPES = {
+    'UInt8': pl.UInt8, 'UInt16': pl.UInt16, 'Int16': pl.Int16, 'float32': pl.Float32
+}
+
+# 集計クエリ用のSQL断片
+_RACE_JOIN_SQL = """
+    JOIN jvd_ra r
+        ON r.kaisai_nen = s.kaisai_nen AND r.kaisai_tsukihi = s.kaisai_tsukihi
+        AND r.keibajo_code = s.keibajo_code AND r.race_bango = s.race_bango"""
+
+_TRACK_TYPE_SQL = """CASE SUBSTRING(r.track_code, 1, 1)
+            WHEN '1' THEN '芝'
+            WHEN '2' THEN 'ダート'
+            ELSE 'その他'
+        END"""
+
+_DISTANCE_CATEGORY_SQL = """CASE
+            WHEN CAST(NULLIF(TRIM(r.kyori), '') AS INTEGER) <= 0 THEN NULL
+            WHEN CAST(NULLIF(TRIM(r.kyori), '') AS INTEGER) <= 1400 THEN '短距離'
+            WHEN CAST(NULLIF(TRIM(r.kyori), '') AS INTEGER) <= 2000 THEN '中距離'
+            WHEN CAST(NULLIF(TRIM(r.kyori), '') AS INTEGER) <= 10000 THEN '長距離'
+        END"""
+
+_RESULT_AGG_SQL = """SUM(CASE WHEN s.kakutei_chakujun = '01' THEN 1 ELSE 0 END) AS win_count,
+        SUM(CASE WHEN s.kakutei_chakujun = '01' AND s.tansho_odds ~ '^[0-9]+$'
+            THEN CAST(s.tansho_odds AS DOUBLE PRECISION) / 10 ELSE 0 END) AS win_odds_sum,
+        AVG(CASE WHEN s.tansho_ninkijun ~ '^[0-9]+$'
+            THEN CAST(s.tansho_ninkijun AS DOUBLE PRECISION) END) AS avg_popularity"""
+
+# 抽出関数ごとの取得可能カラム（カラム名→SELECT句の式）。並びは既定の取得順
+_RACE_BASE_COLUMNS = {
+    'kaisai_nen': 'r.kaisai_nen', 'kaisai_tsukihi': 'r.kaisai_tsukihi',
+    'keibajo_code': 'r.keibajo_code', 'race_bango': 'r.race_bango',
+    'kyori': 'r.kyori', 'track_code': 'r.track_code', 'tenko_code': 'r.tenko_code',
+    'baba_jotai': """CASE 
+            WHEN SUBSTRING(r.track_code, 1, 1) = '1' THEN r.babajotai_code_shiba 
+            ELSE r.babajotai_code_dirt 
+        END""",
+    'shusso_tosu': 'r.shusso_tosu', 'grade_code': 'r.grade_code',
+    'juryo_shubetsu_code': 'r.juryo_shubetsu_code'
+}
+
+_HORSE_RESULT_COLUMNS = {col: f's.{col}' for col in [
+    'kaisai_nen', 'kaisai_tsukihi', 'keibajo_code', 'race_bango',
+    'ketto_toroku_bango', 'bamei', 'wakuban', 'umaban',
+    'barei', 'seibetsu_code', 'bataiju', 'zogen_fugo', 'zogen_sa',
+    'kishu_code', 'kishumei_ryakusho',
+    'chokyoshi_code', 'chokyoshimei_ryakusho',
+    'kakutei_chakujun', 'soha_time', 'kohan_3f',
+    'tansho_odds', 'tansho_ninkijun',
+    'corner_01_tsuka_juni', 'corner_02_tsuka_juni',
+    'corner_03_tsuka_juni', 'corner_04_tsuka_juni'
+]}
+
+_HORSE_PEDIGREE_COLUMNS = {
+    'ketto_toroku_bango': 'u.ketto_toroku_bango',
+    'bamei': 'TRIM(u.bamei)',
+    'seinengappi': 'u.seinengappi',
+    'seibetsu_code': 'u.seibetsu_code',
+    'sire_id': 'u.ketto_joho_01a',
+    'sire_name': 'TRIM(u.ketto_joho_01b)',
+    'dam_id': 'u.ketto_joho_02a',
+    'dam_name': 'TRIM(u.ketto_joho_02b)',
+    'broodmare_sire_id': 'u.ketto_joho_03a',
+    'broodmare_sire_name': 'TRIM(u.ketto_joho_03b)'
+}
+
+_RACE_PAYOUT_COLUMNS = {col: f'hr.{col}' for col in [
+    'kaisai_nen', 'kaisai_tsukihi', 'keibajo_code', 'race_bango',
+    'haraimodoshi_tansho_1', 'haraimodoshi_tansho_2', 'haraimodoshi_tansho_3',
+    'haraimodoshi_fukusho_1', 'haraimodoshi_fukusho_2', 'haraimodoshi_fukusho_3',
+    'haraimodoshi_fukusho_4', 'haraimodoshi_fukusho_5',
+    'haraimodoshi_wakuren_1', 'haraimodoshi_wakuren_2', 'haraimodoshi_wakuren_3',
+    'haraimodoshi_umaren_1', 'haraimodoshi_umaren_2', 'haraimodoshi_umaren_3',
+    'haraimodoshi_wide_1', 'haraimodoshi_wide_2', 'haraimodoshi_wide_3',
+    'haraimodoshi_wide_4', 'haraimodoshi_wide_5', 'haraimodoshi_wide_6', 'haraimodoshi_wide_7',
+    'haraimodoshi_umatan_1', 'haraimodoshi_umatan_2', 'haraimodoshi_umatan_3',
+    'haraimodoshi_sanrenfuku_1', 'haraimodoshi_sanrenfuku_2', 'haraimodoshi_sanrenfuku_3',
+    'haraimodoshi_sanrentan_1', 'haraimodoshi_sanrentan_2', 'haraimodoshi_sanrentan_3'
+]}
+
+# 血統データのディスクキャッシュ（全カラムを文字列のまま保存するParquetデータセット）
+# 接続先ごとのサブディレクトリに保存する。jvd_umに存在しなかった馬IDは
+# 確認時刻(not_found_at, UNIX秒)付きの行として記録し、期限内は再取得しない
+_PEDIGREE_CACHE_ROOT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'cache', 'pedigree'
+)
+_PEDIGREE_CACHE_SCHEMA = pa.schema([(col, pa.string()) for col in [*_HORSE_PEDIGREE_COLUMNS, 'not_found_at']])
+# jvd_umに存在しなかった記録の有効期限（秒）。jvd_umが後から取り込まれる場合に備えて再確認する
+_PEDIGREE_NOT_FOUND_TTL = 24 * 60 * 60
+# キャッシュのファイル数がこれを超えたら1ファイルにまとめ直す
+_PEDIGREE_CACHE_MAX_FILES = 32
+# まとめ直し用のロックファイルがこれより古ければ、異常終了したプロセスのものとみなす（秒）
+_PEDIGREE_CACHE_LOCK_TIMEOUT = 600
+
+# 前走ペース偏差の計算に使う出走結果カラム
+_PACE_RESULT_COLUMNS = [
+    'kaisai_nen', 'kaisai_tsukihi', 'keibajo_code', 'race_bango',
+    'ketto_toroku_bango', 'bamei', 'kakutei_chakujun',
+    'corner_01_tsuka_juni', 'corner_04_tsuka_juni', 'tansho_odds', 'tansho_ninkijun'
+]
+
+def extract_race_base_data(year_from=2010, year_to=2023, chunksize=None, return_type='pandas', columns=None):
     """
     基本レース情報を抽出する関数
     
@@ -16,36 +144,28 @@ def extract_race_base_data(year_from=2010, year_to=2023, chunksize=None):
         year_from (int): 抽出開始年
         year_to (int): 抽出終了年
         chunksize (int, optional): チャンクサイズ。指定するとジェネレータを返す
+        return_type (str): 'pandas'または'polars'
+        columns (list, optional): 取得するカラム名のリスト。指定しない場合は全カラムを取得
     
     Returns:
         DataFrame or Generator: レースデータのDataFrameまたはジェネレータ
     """
-    query = f"""
+    query = """
     SELECT 
-        r.kaisai_nen, r.kaisai_tsukihi, r.keibajo_code, r.race_bango,
-        r.kyori, r.track_code, r.tenko_code, 
-        CASE 
-            WHEN SUBSTRING(r.track_code, 1, 1) = '1' THEN r.babajotai_code_shiba 
-            ELSE r.babajotai_code_dirt 
-        END as baba_jotai,
-        r.shusso_tosu, r.grade_code, r.juryo_shubetsu_code
+        {columns}
     FROM jvd_ra r
     WHERE r.kaisai_nen BETWEEN '{year_from}' AND '{year_to}'
     ORDER BY r.kaisai_nen, r.kaisai_tsukihi, r.keibajo_code, r.race_bango
     """
     
-    engine = get_engine()
-    
     try:
-        if chunksize:
-            return pd.read_sql_query(query, engine, chunksize=chunksize)
-        else:
-            return pd.read_sql_query(query, engine)
+        queries = _split_by_year(query, year_from, year_to, columns=_select_list(_RACE_BASE_COLUMNS, columns))
+        return _read(queries, chunksize=chunksize, return_type=return_type)
     except Exception as e:
         logger.error(f"レースデータ抽出中にエラーが発生しました: {e}")
         return pd.DataFrame()
 
-def extract_horse_result_data(year_from=2010, year_to=2023, chunksize=None):
+def extract_horse_result_data(year_from=2010, year_to=2023, chunksize=None, return_type='pandas', columns=None):
     """
     馬の出走結果データを抽出する関数
     
@@ -53,118 +173,560 @@ def extract_horse_result_data(year_from=2010, year_to=2023, chunksize=None):
         year_from (int): 抽出開始年
         year_to (int): 抽出終了年
         chunksize (int, optional): チャンクサイズ。指定するとジェネレータを返す
+        return_type (str): 'pandas'または'polars'
+        columns (list, optional): 取得するカラム名のリスト。指定しない場合は全カラムを取得
     
     Returns:
         DataFrame or Generator: 馬の結果データのDataFrameまたはジェネレータ
     """
-    query = f"""
+    query = """
     SELECT 
-        s.kaisai_nen, s.kaisai_tsukihi, s.keibajo_code, s.race_bango,
-        s.ketto_toroku_bango, s.bamei, s.wakuban, s.umaban,
-        s.barei, s.seibetsu_code, s.bataiju, s.zogen_fugo, s.zogen_sa,
-        s.kishu_code, s.kishumei_ryakusho, 
-        s.chokyoshi_code, s.chokyoshimei_ryakusho,
-        s.kakutei_chakujun, s.soha_time, s.kohan_3f,
-        s.tansho_odds, s.tansho_ninkijun,
-        s.corner_01_tsuka_juni, s.corner_02_tsuka_juni, 
-        s.corner_03_tsuka_juni, s.corner_04_tsuka_juni
+        {columns}
     FROM jvd_se s
     WHERE s.kaisai_nen BETWEEN '{year_from}' AND '{year_to}'
     ORDER BY s.kaisai_nen, s.kaisai_tsukihi, s.keibajo_code, s.race_bango, s.umaban
     """
     
-    engine = get_engine()
-    
     try:
-        if chunksize:
-            return pd.read_sql_query(query, engine, chunksize=chunksize)
-        else:
-            return pd.read_sql_query(query, engine)
+        queries = _split_by_year(query, year_from, year_to, columns=_select_list(_HORSE_RESULT_COLUMNS, columns))
+        return _read(queries, chunksize=chunksize, return_type=return_type)
     except Exception as e:
         logger.error(f"馬結果データ抽出中にエラーが発生しました: {e}")
         return pd.DataFrame()
 
-def extract_horse_pedigree_data(horse_ids=None):
+def extract_horse_result_minimal_pace(year_from=2010, year_to=2023, chunksize=None, return_type='pandas'):
+    """
+    前走ペース偏差の計算に必要なカラムだけの出走結果データを抽出する関数
+    
+    出走頭数(shusso_tosu)はjvd_seにないため、レースデータ側から取得する
+    
+    Args:
+        year_from (int): 抽出開始年
+        year_to (int): 抽出終了年
+        chunksize (int, optional): チャンクサイズ。指定するとジェネレータを返す
+        return_type (str): 'pandas'または'polars'
+    
+    Returns:
+        DataFrame or Generator: 馬の結果データのDataFrameまたはジェネレータ
+    """
+    return extract_horse_result_data(
+        year_from, year_to, chunksize=chunksize, return_type=return_type, columns=_PACE_RESULT_COLUMNS
+    )
+
+def extract_horse_pedigree_data(horse_ids=None, columns=None, use_cache=True):
     """
     馬の血統データを抽出する関数
     
+    馬IDを指定した場合は、ディスクキャッシュにない馬だけをデータベースから取得してキャッシュに追記する
+    
     Args:
         horse_ids (list, optional): 馬IDのリスト。指定しない場合は全馬を取得
+        columns (list, optional): 取得するカラム名のリスト。指定しない場合は全カラムを取得
+        use_cache (bool): 馬ID指定時にディスクキャッシュを使うかどうか
     
     Returns:
         DataFrame: 馬の血統データのDataFrame
     """
-    if horse_ids:
-        horse_id_list = ",".join([f"'{id}'" for id in horse_ids])
-        where_clause = f"WHERE u.ketto_toroku_bango IN ({horse_id_list})"
-    else:
-        where_clause = ""
-    
-    query = f"""
+    query = """
     SELECT 
-        u.ketto_toroku_bango,
-        TRIM(u.bamei) AS bamei,
-        u.seinengappi,
-        u.seibetsu_code,
-        u.ketto_joho_01a AS sire_id,
-        TRIM(u.ketto_joho_01b) AS sire_name,
-        u.ketto_joho_02a AS dam_id,
-        TRIM(u.ketto_joho_02b) AS dam_name,
-        u.ketto_joho_03a AS broodmare_sire_id,
-        TRIM(u.ketto_joho_03b) AS broodmare_sire_name
+        {columns}
     FROM jvd_um u
-    {where_clause}
     """
     
-    engine = get_engine()
+    # IDの数によらず同じSQL文になるよう配列パラメータで渡す
+    id_filter = "WHERE u.ketto_toroku_bango = ANY(:horse_ids)"
     
     try:
-        return pd.read_sql_query(query, engine)
+        select_list = _select_list(_HORSE_PEDIGREE_COLUMNS, columns)
+        if horse_ids is not None and len(horse_ids) > 0:
+            horse_ids = [str(h) for h in horse_ids]
+            if use_cache:
+                query = query.format(columns=_select_list(_HORSE_PEDIGREE_COLUMNS)) + id_filter
+                pedigree_df = _cached_pedigree(query, horse_ids)
+                return _prepare_frame(pedigree_df[columns or list(_HORSE_PEDIGREE_COLUMNS)].reset_index(drop=True))
+            return _read(query.format(columns=select_list) + id_filter, params={'horse_ids': horse_ids})
+        return _read(query.format(columns=select_list))
     except Exception as e:
         logger.error(f"血統データ抽出中にエラーが発生しました: {e}")
         return pd.DataFrame()
 
-def extract_race_payouts_data(year_from=2010, year_to=2023):
+def extract_race_payouts_data(year_from=2010, year_to=2023, columns=None):
     """
     レース払戻情報を抽出する関数
     
     Args:
         year_from (int): 抽出開始年
         year_to (int): 抽出終了年
+        columns (list, optional): 取得するカラム名のリスト。指定しない場合は全カラムを取得
     
     Returns:
         DataFrame: レース払戻データのDataFrame
     """
-    query = f"""
+    query = """
     SELECT 
-        hr.kaisai_nen, hr.kaisai_tsukihi, hr.keibajo_code, hr.race_bango,
-        hr.haraimodoshi_tansho_1, hr.haraimodoshi_tansho_2, hr.haraimodoshi_tansho_3,
-        hr.haraimodoshi_fukusho_1, hr.haraimodoshi_fukusho_2, hr.haraimodoshi_fukusho_3,
-        hr.haraimodoshi_fukusho_4, hr.haraimodoshi_fukusho_5,
-        hr.haraimodoshi_wakuren_1, hr.haraimodoshi_wakuren_2, hr.haraimodoshi_wakuren_3,
-        hr.haraimodoshi_umaren_1, hr.haraimodoshi_umaren_2, hr.haraimodoshi_umaren_3,
-        hr.haraimodoshi_wide_1, hr.haraimodoshi_wide_2, hr.haraimodoshi_wide_3,
-        hr.haraimodoshi_wide_4, hr.haraimodoshi_wide_5, hr.haraimodoshi_wide_6, hr.haraimodoshi_wide_7,
-        hr.haraimodoshi_umatan_1, hr.haraimodoshi_umatan_2, hr.haraimodoshi_umatan_3,
-        hr.haraimodoshi_sanrenfuku_1, hr.haraimodoshi_sanrenfuku_2, hr.haraimodoshi_sanrenfuku_3,
-        hr.haraimodoshi_sanrentan_1, hr.haraimodoshi_sanrentan_2, hr.haraimodoshi_sanrentan_3
+        {columns}
     FROM jvd_hr hr
     WHERE hr.kaisai_nen BETWEEN '{year_from}' AND '{year_to}'
     ORDER BY hr.kaisai_nen, hr.kaisai_tsukihi, hr.keibajo_code, hr.race_bango
     """
     
-    engine = get_engine()
-    
     try:
-        return pd.read_sql_query(query, engine)
+        return _read(_split_by_year(query, year_from, year_to, columns=_select_list(_RACE_PAYOUT_COLUMNS, columns)))
     except Exception as e:
         logger.error(f"払戻データ抽出中にエラーが発生しました: {e}")
         return pd.DataFrame()
 
-def get_race_id(row):
-    """レースIDを生成する関数"""
-    return f"{row['kaisai_nen']}{row['kaisai_tsukihi']}{row['keibajo_code']}{row['race_bango']}"
+def extract_sire_track_agg(year_from=2010, year_to=2023, min_races=20):
+    """
+    種牡馬×トラック×馬場状態ごとの集計データを抽出する関数
+    
+    集計はデータベース側で行い、グループごとの集計結果のみを取得する
+    
+    Args:
+        year_from (int): 抽出開始年
+        year_to (int): 抽出終了年
+        min_races (int): 最低レース数の閾値
+    
+    Returns:
+        DataFrame: 種牡馬×馬場条件ごとの出走数・勝利数・勝利時オッズ合計・平均人気
+    """
+    query = f"""
+    SELECT 
+        u.ketto_joho_01a AS sire_id,
+        TRIM(u.ketto_joho_01b) AS sire_name,
+        {_TRACK_TYPE_SQL} AS track_type,
+        CASE 
+            WHEN SUBSTRING(r.track_code, 1, 1) = '1' THEN r.babajotai_code_shiba 
+            ELSE r.babajotai_code_dirt 
+        END AS baba_jotai,
+        COUNT(*) AS race_count,
+        {_RESULT_AGG_SQL}
+    FROM jvd_se s
+    {_RACE_JOIN_SQL}
+    JOIN jvd_um u ON u.ketto_toroku_bango = s.ketto_toroku_bango
+    WHERE s.kaisai_nen BETWEEN :year_from AND :year_to
+    GROUP BY 1, 2, 3, 4
+    HAVING COUNT(*) >= :min_count
+    """
+    
+    try:
+        return _read(query, params=_agg_params(year_from, year_to, min_races))
+    except Exception as e:
+        logger.error(f"種牡馬×馬場集計データ抽出中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def extract_jockey_course_agg(year_from=2010, year_to=2023, min_rides=10):
+    """
+    騎手×コース×トラック×距離区分ごとの集計データを抽出する関数
+    
+    集計はデータベース側で行い、グループごとの集計結果のみを取得する
+    
+    Args:
+        year_from (int): 抽出開始年
+        year_to (int): 抽出終了年
+        min_rides (int): 最低騎乗数の閾値
+    
+    Returns:
+        DataFrame: 騎手×コース条件ごとの騎乗数・勝利数・勝利時オッズ合計・平均人気
+    """
+    query = f"""
+    SELECT 
+        s.kishu_code, s.kishumei_ryakusho, s.keibajo_code,
+        {_TRACK_TYPE_SQL} AS track_type,
+        {_DISTANCE_CATEGORY_SQL} AS distance_category,
+        COUNT(*) AS ride_count,
+        {_RESULT_AGG_SQL}
+    FROM jvd_se s
+    {_RACE_JOIN_SQL}
+    WHERE s.kaisai_nen BETWEEN :year_from AND :year_to
+    GROUP BY 1, 2, 3, 4, 5
+    HAVING COUNT(*) >= :min_count
+    """
+    
+    try:
+        return _read(query, params=_agg_params(year_from, year_to, min_rides))
+    except Exception as e:
+        logger.error(f"騎手×コース集計データ抽出中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def extract_horse_course_agg(year_from=2010, year_to=2023, min_races=3):
+    """
+    馬×コース×トラック×距離区分ごとの集計データを抽出する関数
+    
+    集計はデータベース側で行い、グループごとの集計結果のみを取得する
+    
+    Args:
+        year_from (int): 抽出開始年
+        year_to (int): 抽出終了年
+        min_races (int): 最低レース数の閾値
+    
+    Returns:
+        DataFrame: 馬×コース条件ごとの出走数・勝利数・勝利時オッズ合計・平均人気
+    """
+    query = f"""
+    SELECT 
+        s.ketto_toroku_bango, s.bamei, s.keibajo_code,
+        {_TRACK_TYPE_SQL} AS track_type,
+        {_DISTANCE_CATEGORY_SQL} AS distance_category,
+        COUNT(*) AS race_count,
+        {_RESULT_AGG_SQL}
+    FROM jvd_se s
+    {_RACE_JOIN_SQL}
+    WHERE s.kaisai_nen BETWEEN :year_from AND :year_to
+    GROUP BY 1, 2, 3, 4, 5
+    HAVING COUNT(*) >= :min_count
+    """
+    
+    try:
+        return _read(query, params=_agg_params(year_from, year_to, min_races))
+    except Exception as e:
+        logger.error(f"馬×コース集計データ抽出中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def _cached_pedigree(query, horse_ids):
+    """
+    ディスクキャッシュから指定馬の血統データ（全カラム、型変換前の文字列）を取得する
+    
+    キャッシュにない馬だけをqueryで取得し、Parquetデータセットにファイルを追加する
+    """
+    cache_dir = _pedigree_cache_dir()
+    horse_ids = list(set(horse_ids))
+    cached = _read_pedigree_cache_or_empty(cache_dir, horse_ids)
+    
+    # 期限切れの「存在しない」記録は未取得として扱い、jvd_umを再確認する
+    not_found_at = pd.to_numeric(cached['not_found_at'], errors='coerce')
+    cached = cached[~(not_found_at < time.time() - _PEDIGREE_NOT_FOUND_TTL)]
+    
+    missing = list(set(horse_ids).difference(cached['ketto_toroku_bango']))
+    if missing:
+        logger.info(f"キャッシュにない血統データを取得中 ({len(missing)}頭)...")
+        fetched = read_sql_params(query, {'horse_ids': missing}).astype('string')
+        not_found = sorted(set(missing).difference(fetched['ketto_toroku_bango']))
+        new_rows = pd.concat([
+            fetched,
+            pd.DataFrame({'ketto_toroku_bango': not_found, 'not_found_at': str(int(time.time()))}, dtype='string')
+        ], ignore_index=True)
+        table = pa.Table.from_pandas(
+            new_rows, schema=_PEDIGREE_CACHE_SCHEMA, preserve_index=False
+        ).replace_schema_metadata(None)
+        try:
+            pq.write_to_dataset(table, cache_dir)
+            _compact_pedigree_cache(cache_dir)
+        except (OSError, pa.ArrowException) as e:
+            # 取得済みのデータはそのまま返す（キャッシュへの追記は次回に持ち越す）
+            logger.warning(f"血統キャッシュの書き込みに失敗しました: {e}")
+        cached = pd.concat([cached, table.to_pandas()], ignore_index=True)
+    
+    return cached[cached['not_found_at'].isna()].drop(columns='not_found_at')
+
+def _pedigree_cache_dir():
+    """接続先ごとのキャッシュディレクトリ（パスワードを除いた接続文字列のハッシュで分ける）"""
+    # パスワードは'***'に置き換えて表示される
+    url = make_url(get_connection_string()).render_as_string(hide_password=True)
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return os.path.join(_PEDIGREE_CACHE_ROOT, key)
+
+def _read_pedigree_cache_or_empty(cache_dir, horse_ids):
+    """
+    キャッシュから指定馬の行を読み込む
+    
+    他プロセスのまとめ直しでファイルが消えた場合などは1度だけ読み直し、
+    それでも失敗すれば空のDataFrameを返して全頭をデータベースから取得させる
+    """
+    for _ in range(2):
+        try:
+            return _read_pedigree_cache(cache_dir, horse_ids)
+        except (OSError, pa.ArrowException) as e:
+            error = e
+    logger.warning(f"血統キャッシュの読み込みに失敗したためデータベースから取得します: {error}")
+    return _PEDIGREE_CACHE_SCHEMA.empty_table().to_pandas()
+
+def _read_pedigree_cache(cache_dir, horse_ids):
+    """キャッシュから指定馬の行だけを読み込む（同じ馬の行が複数あれば1行にする）"""
+    if not os.path.isdir(cache_dir):
+        return _PEDIGREE_CACHE_SCHEMA.empty_table().to_pandas()
+    table = pq.read_table(
+        cache_dir, schema=_PEDIGREE_CACHE_SCHEMA,
+        filters=[('ketto_toroku_bango', 'in', horse_ids)]
+    )
+    return _dedupe_pedigree(table.to_pandas())
+
+def _dedupe_pedigree(df):
+    """
+    同じ馬の行を1行にする（複数プロセスからの同時追記や、再確認で重複しうる）
+    
+    血統データのある行を優先し、どちらも「存在しない」記録なら新しい方を残す
+    """
+    return df.sort_values(
+        'not_found_at', ascending=False, na_position='first', kind='stable'
+    ).drop_duplicates('ketto_toroku_bango')
+
+def _compact_pedigree_cache(cache_dir):
+    """
+    キャッシュのファイル数が上限を超えたら、重複を除いて1ファイルに書き直す
+    
+    ロックファイルで他プロセスのまとめ直しと排他し、ロックが取れなければ何もしない
+    """
+    if len(_list_cache_files(cache_dir)) <= _PEDIGREE_CACHE_MAX_FILES:
+        return
+    
+    lock_path = os.path.join(cache_dir, '.compact.lock')
+    if not _try_lock(lock_path):
+        return
+    try:
+        # ロック取得後に一覧を取り直し、読み込んだファイルだけを削除する
+        files = _list_cache_files(cache_dir)
+        if len(files) <= _PEDIGREE_CACHE_MAX_FILES:
+            return
+        paths = [os.path.join(cache_dir, f) for f in files]
+        table = pq.read_table(paths, schema=_PEDIGREE_CACHE_SCHEMA)
+        compacted = _dedupe_pedigree(table.to_pandas())
+        
+        # 書き込み途中のファイルは'.'始まりの名前にしてデータセットから読まれないようにする
+        tmp_path = os.path.join(cache_dir, f".{uuid.uuid4().hex}.tmp")
+        pq.write_table(
+            pa.Table.from_pandas(compacted, schema=_PEDIGREE_CACHE_SCHEMA, preserve_index=False)
+            .replace_schema_metadata(None),
+            tmp_path
+        )
+        os.replace(tmp_path, os.path.join(cache_dir, f"{uuid.uuid4().hex}.parquet"))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+def _list_cache_files(cache_dir):
+    """キャッシュのParquetファイル名の一覧"""
+    return [f for f in os.listdir(cache_dir) if f.endswith('.parquet') and not f.startswith('.')]
 
-def get_horse_race_id(row):
-    """馬のレースIDを生成する関数"""
-    return f"{row['kaisai_nen']}{row['kaisai_tsukihi']}{row['keibajo_code']}{row['race_bango']}_{row['ketto_toroku_bango']}"
+def _try_lock(lock_path):
+    """
+    ロックファイルを排他的に作成し、作成できればTrueを返す
+    
+    異常終了で残った古いロックファイルは削除してから1度だけ再試行する
+    """
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) <= _PEDIGREE_CACHE_LOCK_TIMEOUT:
+                    return False
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+    return False
+
+def _read(query, chunksize=None, return_type='pandas', params=None):
+    """
+    クエリを実行し、抽出境界での型変換を適用する
+    
+    paramsを指定した場合はバインドパラメータ付きでSQLAlchemyから読み込む
+    """
+    if params is not None:
+        return _prepare_frame(read_sql_params(query, params))
+    result = read_sql(query, chunksize=chunksize, return_type=return_type)
+    if chunksize:
+        return (_prepare_frame(chunk) for chunk in result)
+    return _prepare_frame(result)
+
+def _agg_params(year_from, year_to, min_count):
+    """集計クエリのバインドパラメータ（kaisai_nenは文字列カラムなので年も文字列で渡す）"""
+    return {'year_from': str(int(year_from)), 'year_to': str(int(year_to)), 'min_count': int(min_count)}
+
+def _prepare_frame(df):
+    """抽出直後のDataFrameの型を整える"""
+    if isinstance(df, pl.DataFrame):
+        return _prepare_polars_frame(df)
+    return _encode_categories(_downcast(df))
+
+def to_polars(df):
+    """
+    DataFrameをPolarsに変換し、抽出境界と同じ型変換を適用する関数
+    
+    Args:
+        df (DataFrame or polars.DataFrame): 抽出済みのデータ
+    
+    Returns:
+        polars.DataFrame: 型変換済みのPolars DataFrame
+    """
+    if not isinstance(df, pl.DataFrame):
+        df = pl.from_pandas(df)
+    return _prepare_polars_frame(df)
+
+def to_columnar(df):
+    """
+    各カラムを独立した連続配列として持つDataFrameに組み直す関数
+    
+    同じ型のカラムが2次元ブロックにまとめられていると、カラム単位の集計で配列を飛び飛びに読むことになる。
+    数値カラムは1カラム1配列の連続配列にし、カテゴリ型などの拡張型はもともとカラムごとの配列なのでそのまま使う
+    
+    Args:
+        df (DataFrame): 出力するDataFrame
+    
+    Returns:
+        DataFrame: カラムごとに連続配列を持つDataFrame
+    """
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+            columns[col] = series.array
+        else:
+            columns[col] = np.ascontiguousarray(series.to_numpy())
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+def _prepare_polars_frame(df, schema=_DOWNCAST_SCHEMA):
+    """
+    抽出直後のPolars DataFrameに_downcast・_encode_categoriesと同じ型変換を適用する
+    
+    文字列のカラムだけを数値に変換し、変換済みのカラム（pandas側で_downcast済みなど）はそのまま使う
+    """
+    exprs = []
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        target = _POLARS_DTYPES[dtype]
+        current = df.schema[col]
+        if current == target:
+            continue
+        if current in (pl.Utf8, pl.Categorical):
+            exprs.append(pl.col(col).cast(pl.Utf8).str.strip_chars().cast(target, strict=False))
+        else:
+            exprs.append(pl.col(col).cast(target, strict=False))
+    exprs += [
+        pl.col(col).cast(pl.Categorical)
+        for col in _CATEGORY_COLUMNS if col in df.columns and df.schema[col] != pl.Categorical
+    ]
+    return df.with_columns(exprs) if exprs else df
+
+def _downcast(df, schema=_DOWNCAST_SCHEMA):
+    """
+    数値カラムを値域に合った型にダウンキャストする
+    
+    数値に変換できない値（'**'や空欄）は欠損とし、平均などの集計から除外されるようにする
+    """
+    for col, dtype in schema.items():
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+    return df
+
+def _encode_categories(df):
+    """文字列キーをカテゴリ型に変換する（groupby・mergeを整数コードで行うため）"""
+    for col in _CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+def _select_list(column_map, columns=None):
+    """
+    取得するカラム名のリストからSELECT句のカラムリストを作成する
+    
+    columnsがNoneの場合はcolumn_mapの全カラム。取得できないカラムが含まれる場合はValueError
+    """
+    if columns is None:
+        columns = list(column_map)
+    unknown = [col for col in columns if col not in column_map]
+    if unknown or not columns:
+        raise ValueError(f"取得できないカラムが指定されました: {unknown or columns}")
+    return ",\n        ".join(
+        column_map[col] if column_map[col].endswith(f".{col}") else f"{column_map[col]} AS {col}"
+        for col in columns
+    )
+
+def _split_by_year(query, year_from, year_to, **fields):
+    """
+    年範囲のクエリを1年ごとのクエリに分割する関数
+
+    kaisai_nenは文字列カラムのためConnectorXのpartition_onが使えないので、
+    年ごとのクエリのリストとして渡して並列に読み込ませる
+    """
+    return [
+        query.format(year_from=year, year_to=year, **fields)
+        for year in range(int(year_from), int(year_to) + 1)
+    ]
+
+def add_race_id(df):
+    """
+    レースIDカラムを追加する関数
+    
+    開催年・月日・競馬場コード・レース番号を列単位で連結する
+    
+    Args:
+        df (DataFrame): kaisai_nen, kaisai_tsukihi, keibajo_code, race_bangoを持つDataFrame
+    
+    Returns:
+        DataFrame: race_idを追加したDataFrame
+    """
+    df['race_id'] = (
+        df['kaisai_nen'].astype('string') + df['kaisai_tsukihi'].astype('string')
+        + df['keibajo_code'].astype('string') + df['race_bango'].astype('string')
+    )
+    return df
+
+def add_race_key(df):
+    """
+    整数のレースキーカラムを追加する関数
+    
+    race_idと同じ4項目をuint64にビットパックする（年<<34 | 月日<<22 | 競馬場<<10 | レース番号）。
+    文字列のrace_idより結合・集計のキーとして軽い。競馬場コードは海外コード（A4等）も含むため36進数で解釈する
+    
+    Args:
+        df (DataFrame): kaisai_nen, kaisai_tsukihi, keibajo_code, race_bangoを持つDataFrame
+    
+    Returns:
+        DataFrame: race_keyを追加したDataFrame
+    """
+    nen = _code_to_uint64(df['kaisai_nen'])
+    tsukihi = _code_to_uint64(df['kaisai_tsukihi'])
+    keibajo = _code_to_uint64(df['keibajo_code'], base=36)
+    bango = _code_to_uint64(df['race_bango'])
+    df['race_key'] = (
+        (nen << np.uint64(34)) | (tsukihi << np.uint64(22)) | (keibajo << np.uint64(10)) | bango
+    )
+    return df
+
+def race_key_expr():
+    """
+    add_race_keyと同じレースキーを計算するPolars式
+    
+    Returns:
+        Expr: race_keyカラムを生成する式
+    """
+    def code(col, base=10):
+        return pl.col(col).cast(pl.Utf8).str.strip_chars().str.to_integer(base=base).cast(pl.UInt64)
+    
+    return (
+        code('kaisai_nen') * (1 << 34) + code('kaisai_tsukihi') * (1 << 22)
+        + code('keibajo_code', base=36) * (1 << 10) + code('race_bango')
+    ).alias('race_key')
+
+def _code_to_uint64(series, base=10):
+    """コード文字列をuint64に変換する（ユニークな値ごとに変換してから展開、欠損は0）"""
+    codes = series.astype('category')
+    table = np.array(
+        [int(str(c).strip(), base) for c in codes.cat.categories] + [0], dtype=np.uint64
+    )
+    return table[codes.cat.codes.values]
+
+def add_horse_race_id(df):
+    """
+    馬のレースIDカラムを追加する関数
+    
+    Args:
+        df (DataFrame): race_idの構成カラムとketto_toroku_bangoを持つDataFrame
+    
+    Returns:
+        DataFrame: race_idとhorse_race_idを追加したDataFrame
+    """
+    if 'race_id' not in df.columns:
+        add_race_id(df)
+    df['horse_race_id'] = df['race_id'] + '_' + df['ketto_toroku_bango'].astype('string')
+    return df
@@ -0,0 +1,85 @@
+"""
+ペース展開の行単位判定カーネル
+
+各判定をNumbaで1本の並列ループに融合し、中間配列を作らずにint8コードを出力する。
+入力はint16の配列で、欠損は負の値（-1）で表す。コードの意味はpace_features.pyのラベル配列に対応する。
+"""
+import numpy as np
+from numba import njit, prange
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def classify_running_style(corner01, corner04, chakujun, shusso):
+    """
+    脚質を判定する（0:不明, 1:先行, 2:差し, 3:追込）
+
+    第1コーナー3番手以内なら先行、それ以外は上がり率 (4コーナー通過順 - 着順) / 出走頭数 が
+    0.2を超えれば差し、以下なら追込
+    """
+    n = corner01.shape[0]
+    out = np.zeros(n, dtype=np.int8)
+    for i in prange(n):
+        if corner01[i] < 0:
+            continue
+        if corner01[i] <= 3:
+            out[i] = 1
+            continue
+        if corner04[i] < 0 or chakujun[i] < 0 or shusso[i] < 0:
+            continue
+        up_rate = (np.float64(corner04[i]) - chakujun[i]) / np.float64(shusso[i])
+        if up_rate > 0.2:
+            out[i] = 2
+        elif up_rate <= 0.2:
+            out[i] = 3
+    return out
+
+@njit(parallel=True, cache=True)
+def classify_pace_advantage(running_style, pace_type):
+    """
+    脚質とペースの相性から展開適性を判定する（0:中立, 1:有利, 2:不利）
+
+    先行×スロー・差し×ハイは有利、先行×ハイ・差し×スローは不利
+    """
+    n = running_style.shape[0]
+    out = np.zeros(n, dtype=np.int8)
+    for i in prange(n):
+        style = running_style[i]
+        pace = pace_type[i]
+        if (style == 1 and pace == 1) or (style == 2 and pace == 2):
+            out[i] = 1
+        elif (style == 1 and pace == 2) or (style == 2 and pace == 1):
+            out[i] = 2
+    return out
+
+@njit(parallel=True, cache=True)
+def classify_prev_pattern(prev_pace_advantage, prev_finish):
+    """
+    前走結果の区分と、前走の展開適性との組み合わせパターンを判定する
+
+    Returns:
+        tuple: 前走結果（0:不明, 1:好走, 2:凡走, 3:大敗）と
+            パターン（0:中立, 1:展開不利→大敗, 2:展開不利→凡走, 3:展開不利→好走,
+            4:展開有利→大敗, 5:展開有利→好走）
+    """
+    n = prev_finish.shape[0]
+    performance = np.zeros(n, dtype=np.int8)
+    pattern = np.zeros(n, dtype=np.int8)
+    for i in prange(n):
+        finish = prev_finish[i]
+        if finish < 0:
+            continue
+        if finish <= 3:
+            perf = 1
+        elif finish <= 5:
+            perf = 2
+        else:
+            perf = 3
+        performance[i] = perf
+
+        adv = prev_pace_advantage[i]
+        if adv == 2:
+            pattern[i] = 4 - perf  # 大敗→1, 凡走→2, 好走→3
+        elif adv == 1 and perf == 3:
+            pattern[i] = 4
+        elif adv == 1 and perf == 1:
+            pattern[i] = 5
+    return performance, pattern
@@ -4,9 +4,40 @@
 import pandas as pd
 import numpy as np
 import logging
+from ..data.extraction import add_race_id, add_race_key, to_columnar
+from ._classify import classify_running_style, classify_pace_advantage, classify_prev_pattern
 
 logger = logging.getLogger(__name__)
 
+# 判定結果はint8のコードで保持し、返却時にカテゴリ型へ変換する（カテゴリの位置がコード）
+RUNNING_STYLE_DTYPE = pd.CategoricalDtype(['不明', '先行', '差し', '追込'])
+PACE_TYPE_DTYPE = pd.CategoricalDtype(['不明', 'スロー', 'ハイ'])
+PACE_ADVANTAGE_DTYPE = pd.CategoricalDtype(['中立', '有利', '不利'])
+PERFORMANCE_DTYPE = pd.CategoricalDtype(['不明', '好走', '凡走', '大敗'])
+PATTERN_DTYPE = pd.CategoricalDtype(['中立', '展開不利→大敗', '展開不利→凡走', '展開不利→好走', '展開有利→大敗', '展開有利→好走'])
+
+# 脚質コード
+_STYLE_LEAD = 1
+# ペースコード
+_PACE_SLOW, _PACE_HIGH = 1, 2
+
+def _to_soa(df, cols):
+    """必要なカラムだけを連続したNumPy配列の辞書（SoA）として取り出す"""
+    return {c: np.ascontiguousarray(df[c].to_numpy()) for c in cols}
+
+def _as_int16(values):
+    """判定カーネル用に連続したint16配列へ変換する（欠損は-1）"""
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = np.where(np.isnan(values), -1, values)
+    return np.ascontiguousarray(values, dtype=np.int16)
+
+def _shift_within(values, same_group):
+    """1行前の値を取得する（1行前が別グループなら欠損の-1）"""
+    prev = np.full(values.shape[0], -1, dtype=np.int16)
+    prev[1:] = np.where(same_group, values[:-1], -1)
+    return prev
+
 def calculate_pace_disadvantage(race_df, result_df):
     """
     前走ペース偏差（展開不利指標）を計算する関数
@@ -21,105 +52,87 @@ def calculate_pace_disadvantage(race_df, result_df):
         DataFrame: 前走ペース偏差のDataFrame
     """
     try:
-        # レースIDの作成
-        race_df['race_id'] = race_df['kaisai_nen'] + race_df['kaisai_tsukihi'] + race_df['keibajo_code'] + race_df['race_bango']
-        result_df['race_id'] = result_df['kaisai_nen'] + result_df['kaisai_tsukihi'] + result_df['keibajo_code'] + result_df['race_bango']
-        
-        # データ結合
-        df = pd.merge(result_df, race_df, on='race_id', suffixes=('', '_race'))
-        
-        # レース日付の作成
-        df['race_date'] = pd.to_datetime(df['kaisai_nen'] + df['kaisai_tsukihi'], format='%Y%m%d')
+        # レースキーの作成（結合・集計は整数キーで行い、race_idは出力用に結果側のみ作成）
+        add_race_key(race_df)
+        add_race_key(result_df)
+        add_race_id(result_df)
+        
+        # 使用するカラムだけを配列として取り出す
+        race = _to_soa(race_df, ['race_key', 'shusso_tosu'])
+        res = _to_soa(result_df, ['race_key', 'corner_01_tsuka_juni', 'corner_04_tsuka_juni', 'kakutei_chakujun'])
+        for col in ['corner_01_tsuka_juni', 'corner_04_tsuka_juni', 'kakutei_chakujun']:
+            res[col] = pd.to_numeric(res[col], errors='coerce')
+        shusso = _as_int16(pd.to_numeric(race['shusso_tosu'], errors='coerce'))
+        race_date = pd.to_datetime(
+            race_df['kaisai_nen'].astype(str) + race_df['kaisai_tsukihi'].astype(str), format='%Y%m%d'
+        ).to_numpy()
+        
+        # データ結合（各出走行に対応するレースの位置。レース情報のない行は除外）
+        race_pos = pd.Index(race['race_key']).get_indexer(res['race_key'])
+        rows = np.flatnonzero(race_pos >= 0)
+        race_pos = race_pos[rows]
+        chakujun = _as_int16(res['kakutei_chakujun'][rows])
         
         # 脚質の判定
-        df['corner_01_tsuka_juni'] = pd.to_numeric(df['corner_01_tsuka_juni'], errors='coerce')
-        df['corner_04_tsuka_juni'] = pd.to_numeric(df['corner_04_tsuka_juni'], errors='coerce')
-        df['kakutei_chakujun'] = pd.to_numeric(df['kakutei_chakujun'], errors='coerce')
-        
-        # 先行率: (4コーナー通過順 - 最終着順) / 出走頭数
-        df['shusso_tosu'] = pd.to_numeric(df['shusso_tosu'], errors='coerce')
-        df['up_rate'] = (df['corner_04_tsuka_juni'] - df['kakutei_chakujun']) / df['shusso_tosu']
-        
-        # 脚質の判定
-        conditions = [
-            (df['corner_01_tsuka_juni'] <= 3),  # 第1コーナーで上位3番手以内なら逃げ・先行
-            (df['corner_01_tsuka_juni'] > 3) & (df['up_rate'] > 0.2),  # 後方から上がってきたら差し
-            (df['corner_01_tsuka_juni'] > 3) & (df['up_rate'] <= 0.2)  # それ以外なら追込
-        ]
-        choices = ['先行', '差し', '追込']
-        df['running_style'] = np.select(conditions, choices, default='不明')
+        # 第1コーナー3番手以内なら先行、後方から上がってきたら差し、それ以外なら追込
+        # 上がり率: (4コーナー通過順 - 最終着順) / 出走頭数
+        running_style = classify_running_style(
+            _as_int16(res['corner_01_tsuka_juni'][rows]), _as_int16(res['corner_04_tsuka_juni'][rows]),
+            chakujun, shusso[race_pos]
+        )
         
         # レースごとのペース判定
         # 先行馬の着順平均を計算し、先行有利（スロー）かハイペースかを判定
-        race_pace = df.groupby('race_id').apply(
-            lambda x: pd.Series({
-                'lead_horse_count': sum(x['running_style'] == '先行'),
-                'lead_horse_avg_rank': x.loc[x['running_style'] == '先行', 'kakutei_chakujun'].mean(),
-                'closing_horse_count': sum(x['running_style'] == '差し'),
-                'closing_horse_avg_rank': x.loc[x['running_style'] == '差し', 'kakutei_chakujun'].mean(),
-                'race_date': x['race_date'].iloc[0],  # レース日付
-                'shusso_tosu': x['shusso_tosu'].iloc[0]  # 出走頭数
-            })
-        ).reset_index()
+        n_races = race['race_key'].shape[0]
+        lead_ranked = (running_style == _STYLE_LEAD) & (chakujun >= 0)
+        lead_rank_sum = np.bincount(race_pos, weights=np.where(lead_ranked, chakujun, 0), minlength=n_races)
+        lead_rank_count = np.bincount(race_pos, weights=lead_ranked, minlength=n_races)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lead_avg_rank = lead_rank_sum / lead_rank_count
+        race_shusso = np.where(shusso >= 0, shusso, np.nan)
         
         # ペース判定
         conditions = [
-            (race_pace['lead_horse_avg_rank'] < race_pace['shusso_tosu'] / 2),  # 先行馬の平均着順が出走頭数の半分より良い
-            (race_pace['lead_horse_avg_rank'] >= race_pace['shusso_tosu'] / 2)  # 先行馬の平均着順が出走頭数の半分以上
+            (lead_avg_rank < race_shusso / 2),  # 先行馬の平均着順が出走頭数の半分より良い
+            (lead_avg_rank >= race_shusso / 2)  # 先行馬の平均着順が出走頭数の半分以上
         ]
-        choices = ['スロー', 'ハイ']
-        race_pace['pace_type'] = np.select(conditions, choices, default='不明')
-        
-        # 脚質とペースの相性判定
-        race_pace = race_pace[['race_id', 'pace_type']]
-        df = pd.merge(df, race_pace, on='race_id')
+        choices = [_PACE_SLOW, _PACE_HIGH]
+        pace_type = np.select(conditions, choices, default=0).astype('int8')[race_pos]
         
         # 展開適性の判定
-        conditions = [
-            (df['running_style'] == '先行') & (df['pace_type'] == 'スロー'),
-            (df['running_style'] == '差し') & (df['pace_type'] == 'ハイ'),
-            (df['running_style'] == '先行') & (df['pace_type'] == 'ハイ'),
-            (df['running_style'] == '差し') & (df['pace_type'] == 'スロー')
-        ]
-        choices = ['有利', '有利', '不利', '不利']
-        df['pace_advantage'] = np.select(conditions, choices, default='中立')
+        pace_advantage = classify_pace_advantage(_as_int16(running_style), _as_int16(pace_type))
         
         # 前走情報を取得
-        # 各馬ごとにレース日付でソートし、前走の情報を取得
-        horse_df = df.sort_values(['ketto_toroku_bango', 'race_date'])
-        
-        # 前走の展開と着順
-        horse_df['prev_pace_advantage'] = horse_df.groupby('ketto_toroku_bango')['pace_advantage'].shift(1)
-        horse_df['prev_finish_pos'] = horse_df.groupby('ketto_toroku_bango')['kakutei_chakujun'].shift(1)
-        
-        # 前走結果の区分
-        conditions = [
-            (horse_df['prev_finish_pos'] <= 3),
-            (horse_df['prev_finish_pos'] <= 5),
-            (horse_df['prev_finish_pos'] > 5)
-        ]
-        choices = ['好走', '凡走', '大敗']
-        horse_df['prev_performance'] = np.select(conditions, choices, default='不明')
-        
-        # 展開不利と着順の組み合わせ
-        conditions = [
-            (horse_df['prev_pace_advantage'] == '不利') & (horse_df['prev_performance'] == '大敗'),
-            (horse_df['prev_pace_advantage'] == '不利') & (horse_df['prev_performance'] == '凡走'),
-            (horse_df['prev_pace_advantage'] == '不利') & (horse_df['prev_performance'] == '好走'),
-            (horse_df['prev_pace_advantage'] == '有利') & (horse_df['prev_performance'] == '大敗'),
-            (horse_df['prev_pace_advantage'] == '有利') & (horse_df['prev_performance'] == '好走')
-        ]
-        choices = ['展開不利→大敗', '展開不利→凡走', '展開不利→好走', '展開有利→大敗', '展開有利→好走']
-        horse_df['prev_pattern'] = np.select(conditions, choices, default='中立')
-        
-        # 結果を整形
-        result = horse_df[
-            ['ketto_toroku_bango', 'bamei', 'race_id', 'race_date', 
-             'running_style', 'pace_type', 'pace_advantage', 
-             'prev_pace_advantage', 'prev_performance', 'prev_pattern']
-        ].copy()
-        
-        return result.dropna(subset=['prev_pattern'])  # 前走情報がある馬のみを返す
+        # 各馬ごとにレース日付（同日ならレースキー）でソートし、前走の情報を取得
+        horse_codes, _ = pd.factorize(result_df['ketto_toroku_bango'].to_numpy()[rows], sort=True)
+        order = np.lexsort((res['race_key'][rows], horse_codes))
+        # 馬IDが欠損している行（コード-1）は同じ馬として扱わない
+        sorted_codes = horse_codes[order]
+        same_horse = (sorted_codes[1:] == sorted_codes[:-1]) & (sorted_codes[1:] >= 0)
+        
+        # 前走の展開と着順（ソート済みなので1行前が同じ馬なら前走）
+        prev_pace_advantage = _shift_within(pace_advantage[order], same_horse)
+        prev_finish_pos = _shift_within(chakujun[order], same_horse)
+        
+        # 前走結果の区分と、展開不利と着順の組み合わせ
+        prev_performance, prev_pattern = classify_prev_pattern(prev_pace_advantage, prev_finish_pos)
+        
+        # 結果を整形（コードをカテゴリ型に変換。負のコードは欠損になる）
+        out_rows = rows[order]
+        result = pd.DataFrame({
+            'ketto_toroku_bango': result_df['ketto_toroku_bango'].array.take(out_rows),
+            'bamei': result_df['bamei'].array.take(out_rows),
+            'race_id': result_df['race_id'].array.take(out_rows),
+            'race_date': race_date[race_pos[order]],
+            'running_style': pd.Categorical.from_codes(running_style[order], dtype=RUNNING_STYLE_DTYPE),
+            'pace_type': pd.Categorical.from_codes(pace_type[order], dtype=PACE_TYPE_DTYPE),
+            'pace_advantage': pd.Categorical.from_codes(pace_advantage[order], dtype=PACE_ADVANTAGE_DTYPE),
+            'prev_pace_advantage': pd.Categorical.from_codes(prev_pace_advantage, dtype=PACE_ADVANTAGE_DTYPE),
+            'prev_performance': pd.Categorical.from_codes(prev_performance, dtype=PERFORMANCE_DTYPE),
+            'prev_pattern': pd.Categorical.from_codes(prev_pattern, dtype=PATTERN_DTYPE)
+        })
+        
+        return to_columnar(result.dropna(subset=['prev_pattern']))  # 前走情報がある馬のみを返す
     
     except Exception as e:
         logger.error(f"前走ペース偏差の計算中にエラーが発生しました: {e}")
@@ -148,23 +161,26 @@ def calculate_pace_disadvantage_scores(pace_df):
         
         # 数値型への変換
         pace_df['kakutei_chakujun'] = pd.to_numeric(pace_df['kakutei_chakujun'], errors='coerce')
-        pace_df['tansho_odds'] = pd.to_numeric(pace_df['tansho_odds'], errors='coerce') / 10
-        pace_df['tansho_ninkijun'] = pd.to_numeric(pace_df['tansho_ninkijun'], errors='coerce')
+        pace_df['tansho_odds'] = pd.to_numeric(pace_df['tansho_odds'], errors='coerce').astype('float64') / 10
+        pace_df['tansho_ninkijun'] = pd.to_numeric(pace_df['tansho_ninkijun'], errors='coerce').astype('float64')
         
         # 勝利フラグ
-        pace_df['win'] = (pace_df['kakutei_chakujun'] == 1).astype(int)
-        pace_df['top3'] = (pace_df['kakutei_chakujun'] <= 3).astype(int)
+        pace_df['win'] = (pace_df['kakutei_chakujun'] == 1).fillna(False).astype(int)
+        pace_df['top3'] = (pace_df['kakutei_chakujun'] <= 3).fillna(False).astype(int)
         
         # 人気以上の成績（着順 < 人気順）
-        pace_df['over_popularity'] = (pace_df['kakutei_chakujun'] < pace_df['tansho_ninkijun']).astype(int)
+        pace_df['over_popularity'] = (pace_df['kakutei_chakujun'] < pace_df['tansho_ninkijun']).fillna(False).astype(int)
+        
+        # 勝利時のみのオッズ（グループごとの合計が勝利時オッズ合計になる）
+        pace_df['win_odds_contrib'] = pace_df['tansho_odds'].where(pace_df['win'] == 1, 0.0)
         
         # パターン別の集計
-        pattern_stats = pace_df.groupby('prev_pattern').agg(
+        pattern_stats = pace_df.groupby('prev_pattern', sort=False, observed=True).agg(
             race_count=('race_id', 'count'),
             win_count=('win', 'sum'),
             top3_count=('top3', 'sum'),
             over_popularity_count=('over_popularity', 'sum'),
-            win_odds_sum=('tansho_odds', lambda x: pace_df.loc[pace_df['win'] == 1, 'tansho_odds'].sum()),
+            win_odds_sum=('win_odds_contrib', 'sum'),
             avg_popularity=('tansho_ninkijun', 'mean')
         ).reset_index()
         
@@ -181,7 +197,7 @@ def calculate_pace_disadvantage_scores(pace_df):
         # 人気対比の観点も加味（人気以上に走る率が高いほど高評価）
         pattern_stats['score'] = pattern_stats['score'] + (pattern_stats['over_popularity_rate'] - 50) / 10  # 10%につき1ポイント
         
-        return pattern_stats
+        return to_columnar(pattern_stats)
     
     except Exception as e:
         logger.error(f"ペース偏差スコアの計算中にエラーが発生しました: {e}")
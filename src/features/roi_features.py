@@ -3,252 +3,485 @@
 """
 import pandas as pd
 import numpy as np
+import polars as pl
 import logging
-from ..data.extraction import extract_horse_pedigree_data
+from ..data.extraction import (
+    add_race_key, race_key_expr, to_polars, to_columnar,
+    extract_race_base_data, extract_horse_result_data,
+    extract_horse_pedigree_data, extract_sire_track_agg,
+    extract_jockey_course_agg, extract_horse_course_agg
+)
 
 logger = logging.getLogger(__name__)
 
-def calculate_sire_track_roi(race_df, result_df, min_races=20):
+# 競馬場コード→競馬場名
+_COURSE_NAMES = {
+    '01': '札幌', '02': '函館', '03': '福島', '04': '新潟',
+    '05': '東京', '06': '中山', '07': '中京', '08': '京都',
+    '09': '阪神', '10': '小倉'
+}
+
+# トラックコード1文字目→トラック種別コード（TRACK_TYPE_DTYPEのカテゴリの位置）
+_TRACK_MAP = {'1': 1, '2': 2}
+
+# 馬場状態コード→馬場状態
+_TRACK_CONDITIONS = {'1': '良', '2': '稍重', '3': '重', '4': '不良', '0': '未設定'}
+
+# 抽出時に取得するカラム
+_RACE_KEY_COLUMNS = ['kaisai_nen', 'kaisai_tsukihi', 'keibajo_code', 'race_bango']
+_SIRE_PEDIGREE_COLUMNS = ['ketto_toroku_bango', 'sire_id', 'sire_name']
+
+# ラベルカラムのカテゴリ型
+TRACK_TYPE_DTYPE = pd.CategoricalDtype(['その他', '芝', 'ダート'])
+TRACK_CONDITION_DTYPE = pd.CategoricalDtype(['良', '稍重', '重', '不良', '未設定'])
+COURSE_NAME_DTYPE = pd.CategoricalDtype(list(_COURSE_NAMES.values()))
+DISTANCE_CATEGORY_DTYPE = pd.CategoricalDtype(['短距離', '中距離', '長距離'], ordered=True)
+REPEATER_LEVEL_DTYPE = pd.CategoricalDtype(
+    ['WEAK_REPEATER', 'AVERAGE_REPEATER', 'GOOD_REPEATER', 'STRONG_REPEATER'], ordered=True
+)
+
+# ラベルカラムのPolars側の型（カテゴリの並びは上のカテゴリ型と同じ）
+_TRACK_TYPE_ENUM = pl.Enum(list(TRACK_TYPE_DTYPE.categories))
+_TRACK_CONDITION_ENUM = pl.Enum(list(TRACK_CONDITION_DTYPE.categories))
+_COURSE_NAME_ENUM = pl.Enum(list(COURSE_NAME_DTYPE.categories))
+_DISTANCE_CATEGORY_ENUM = pl.Enum(list(DISTANCE_CATEGORY_DTYPE.categories))
+_REPEATER_LEVEL_ENUM = pl.Enum(list(REPEATER_LEVEL_DTYPE.categories))
+
+def _add_track_type_code(df):
+    """トラックコードからトラック種別コード（0:その他, 1:芝, 2:ダート）を追加する"""
+    df['track_type_code'] = (
+        df['track_code'].astype('string').str[0].map(_TRACK_MAP).fillna(0).astype('int8')
+    )
+    return df
+
+def _decode_track_type(data):
+    """集計後のトラック種別コードをラベルのtrack_typeカラムに置き換える"""
+    data.insert(
+        data.columns.get_loc('track_type_code'), 'track_type',
+        pd.Categorical.from_codes(data['track_type_code'].values, dtype=TRACK_TYPE_DTYPE)
+    )
+    return data.drop(columns='track_type_code')
+
+def _repeater_level(win_rate):
+    """勝率からリピーターレベルを判定する"""
+    return pd.cut(
+        win_rate,
+        bins=[-0.1, 10, 15, 25, 100],
+        labels=REPEATER_LEVEL_DTYPE.categories
+    )
+
+def _add_rate_columns(data, count_col):
+    """集計データに勝率・回収率・平均勝利オッズを追加する"""
+    data['win_rate'] = data['win_count'] / data[count_col] * 100
+    data['roi'] = data['win_odds_sum'] / data[count_col] * 100
+    
+    # 平均勝利オッズの計算 (0除算回避)
+    win_count = data['win_count'].values
+    data['avg_win_odds'] = np.where(
+        win_count > 0, data['win_odds_sum'].values / np.maximum(win_count, 1), 0.0
+    )
+    return data
+
+def _join_race_lazy(race, result, race_cols):
+    """
+    出走結果とレース情報（to_polarsで変換済み）をrace_keyで結合したLazyFrameを作成する
+    
+    勝利フラグ(win)、単勝オッズ(tansho_odds, 倍率)、勝利時のみのオッズ(win_odds_contrib)を追加する
+    """
+    race = race.lazy().select(race_key_expr(), *race_cols)
+    result = result.lazy().with_columns(race_key_expr())
+    return result.join(race, on='race_key', how='inner').with_columns(
+        win=(pl.col('kakutei_chakujun') == 1).cast(pl.Int64),
+        tansho_odds=pl.col('tansho_odds').cast(pl.Float64) / 10
+    ).with_columns(
+        win_odds_contrib=pl.when(pl.col('win') == 1).then(pl.col('tansho_odds')).otherwise(0.0)
+    )
+
+def _track_type_expr():
+    """トラックコードの1文字目からトラック種別を判定する式"""
+    return pl.col('track_code').cast(pl.Utf8).str.slice(0, 1).replace_strict(
+        {'1': '芝', '2': 'ダート'}, default='その他', return_dtype=_TRACK_TYPE_ENUM
+    ).alias('track_type')
+
+def _label_expr(col, mapping, dtype, alias):
+    """コードをラベルに変換する式（対応のないコードは欠損）"""
+    return pl.col(col).cast(pl.Utf8).replace_strict(mapping, default=None, return_dtype=dtype).alias(alias)
+
+def _distance_category_expr():
+    """距離区分の式（短距離: 1400m以下, 中距離: 2000m以下, 長距離: それ以上）"""
+    kyori = pl.col('kyori')
+    return (
+        pl.when((kyori > 0) & (kyori <= 1400)).then(pl.lit('短距離'))
+        .when((kyori > 1400) & (kyori <= 2000)).then(pl.lit('中距離'))
+        .when((kyori > 2000) & (kyori <= 10000)).then(pl.lit('長距離'))
+        .cast(_DISTANCE_CATEGORY_ENUM).alias('distance_category')
+    )
+
+def _aggregate_roi(lf, keys, count_col, min_count):
+    """
+    グループごとの件数・勝利数・勝利時オッズ合計・平均人気と、勝率・回収率・平均勝利オッズを計算する
+    
+    キーに欠損のある行は集計しない。最低件数で絞り込み、回収率の降順で返す。
+    """
+    return lf.drop_nulls(keys).group_by(keys).agg(
+        pl.len().cast(pl.Int64).alias(count_col),
+        pl.col('win').sum().alias('win_count'),
+        pl.col('win_odds_contrib').sum().alias('win_odds_sum'),
+        pl.col('tansho_ninkijun').cast(pl.Float64).mean().alias('avg_popularity')
+    ).filter(pl.col(count_col) >= min_count).with_columns(
+        win_rate=pl.col('win_count') / pl.col(count_col) * 100,
+        roi=pl.col('win_odds_sum') / pl.col(count_col) * 100,
+        avg_win_odds=pl.when(pl.col('win_count') > 0)
+            .then(pl.col('win_odds_sum') / pl.col('win_count')).otherwise(0.0)
+    ).sort('roi', descending=True, nulls_last=True)
+
+def _to_output(lf, return_type):
+    """集計結果を収集し、必要に応じてラベルをカテゴリ型にしたpandasのDataFrameに変換する"""
+    data = lf.collect(engine='streaming')
+    if return_type == 'polars':
+        return data
+    data = data.to_pandas()
+    dtypes = {
+        'track_type': TRACK_TYPE_DTYPE, 'track_condition': TRACK_CONDITION_DTYPE,
+        'course_name': COURSE_NAME_DTYPE, 'distance_category': DISTANCE_CATEGORY_DTYPE,
+        'repeater_level': REPEATER_LEVEL_DTYPE
+    }
+    return to_columnar(data.astype({col: dtype for col, dtype in dtypes.items() if col in data.columns}))
+
+def calculate_sire_track_roi(race_df, result_df, min_races=20, return_type='pandas'):
     """
     種牡馬×馬場適性ROIを計算する関数
     
     種牡馬の産駒が特定の馬場条件でどれだけ回収率が高いかを計算する
     
     Args:
-        race_df (DataFrame): レース基本情報のDataFrame
-        result_df (DataFrame): レース結果のDataFrame
+        race_df (DataFrame or polars.DataFrame): レース基本情報のDataFrame
+        result_df (DataFrame or polars.DataFrame): レース結果のDataFrame
         min_races (int): 最低レース数の閾値
+        return_type (str): 'pandas'または'polars'
     
     Returns:
         DataFrame: 種牡馬×馬場適性ROIのDataFrame
     """
     try:
-        # レースIDの作成
-        race_df['race_id'] = race_df['kaisai_nen'] + race_df['kaisai_tsukihi'] + race_df['keibajo_code'] + race_df['race_bango']
-        result_df['race_id'] = result_df['kaisai_nen'] + result_df['kaisai_tsukihi'] + result_df['keibajo_code'] + result_df['race_bango']
-        
         # データ結合
-        df = pd.merge(result_df, race_df, on='race_id', suffixes=('', '_race'))
-        
-        # 勝利フラグを追加
-        df['win'] = (df['kakutei_chakujun'] == '01').astype(int)
+        result = to_polars(result_df)
+        lf = _join_race_lazy(to_polars(race_df), result, ['track_code', 'baba_jotai'])
         
         # 馬場状態の判定
-        df['track_type'] = df['track_code'].apply(
-            lambda x: '芝' if str(x).startswith('1') else 'ダート' if str(x).startswith('2') else 'その他'
-        )
-        
-        df['track_condition'] = df['baba_jotai'].map(
-            {'1': '良', '2': '稍重', '3': '重', '4': '不良', '0': '未設定'}
+        lf = lf.with_columns(
+            _track_type_expr(),
+            _label_expr('baba_jotai', _TRACK_CONDITIONS, _TRACK_CONDITION_ENUM, 'track_condition')
         )
         
-        # 血統データ取得
-        horse_ids = df['ketto_toroku_bango'].unique()
+        # 血統データ取得（結合を2回実行しないよう、馬IDは結合前の出走結果から取る）
+        horse_ids = result['ketto_toroku_bango'].drop_nulls().cast(pl.Utf8).unique()
         logger.info(f"血統データを取得中 ({len(horse_ids)}頭)...")
-        pedigree_df = extract_horse_pedigree_data(horse_ids)
+        pedigree_df = extract_horse_pedigree_data(horse_ids.to_list(), columns=_SIRE_PEDIGREE_COLUMNS)
         
         # 血統情報を結合
-        df = pd.merge(df, pedigree_df[['ketto_toroku_bango', 'sire_id', 'sire_name']], 
-                     on='ketto_toroku_bango', how='left')
-        
-        # 数値型への変換
-        df['tansho_odds'] = pd.to_numeric(df['tansho_odds'], errors='coerce') / 10
-        df['tansho_ninkijun'] = pd.to_numeric(df['tansho_ninkijun'], errors='coerce')
+        pedigree = to_polars(pedigree_df).lazy().select(
+            pl.col('ketto_toroku_bango').cast(pl.Utf8),
+            pl.col('sire_id').cast(pl.Utf8), pl.col('sire_name').cast(pl.Utf8)
+        )
+        lf = lf.with_columns(pl.col('ketto_toroku_bango').cast(pl.Utf8)).join(
+            pedigree, on='ketto_toroku_bango', how='left'
+        )
         
         # 種牡馬×トラック×馬場状態のグループ集計
-        roi_data = df.groupby(['sire_id', 'sire_name', 'track_type', 'track_condition']).agg(
-            race_count=('race_id', 'count'),
-            win_count=('win', 'sum'),
-            win_odds_sum=('tansho_odds', lambda x: df.loc[df['win'] == 1, 'tansho_odds'].sum()),
-            avg_popularity=('tansho_ninkijun', 'mean')
-        ).reset_index()
-        
-        # 勝率と回収率の計算
-        roi_data['win_rate'] = roi_data['win_count'] / roi_data['race_count'] * 100
-        roi_data['roi'] = roi_data['win_odds_sum'] / roi_data['race_count'] * 100
-        
-        # 平均勝利オッズの計算 (0除算回避)
-        roi_data['avg_win_odds'] = roi_data.apply(
-            lambda x: x['win_odds_sum'] / x['win_count'] if x['win_count'] > 0 else 0, 
-            axis=1
-        )
+        return _to_output(_aggregate_roi(
+            lf, ['sire_id', 'sire_name', 'track_type', 'track_condition'], 'race_count', min_races
+        ), return_type)
+    
+    except Exception as e:
+        logger.error(f"種牡馬×馬場適性ROI計算中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def calculate_sire_track_roi_streaming(year_from=2010, year_to=2023, min_races=20, chunksize=500_000):
+    """
+    種牡馬×馬場適性ROIを出走結果のチャンク単位で集計して計算する関数
+    
+    出走結果をchunksize行ずつ読み込み、グループごとの部分集計を足し合わせてから率を計算する。
+    メモリ使用量は全出走数ではなくグループ数に比例する。
+    
+    Args:
+        year_from (int): 集計開始年
+        year_to (int): 集計終了年
+        min_races (int): 最低レース数の閾値
+        chunksize (int): 1チャンクあたりの行数
+    
+    Returns:
+        DataFrame: 種牡馬×馬場適性ROIのDataFrame
+    """
+    try:
+        # レース単位の属性は先にまとめて判定しておく
+        race_df = add_race_key(extract_race_base_data(
+            year_from, year_to, columns=_RACE_KEY_COLUMNS + ['track_code', 'baba_jotai']
+        ))
+        _add_track_type_code(race_df)
+        race_df['track_condition'] = race_df['baba_jotai'].map(_TRACK_CONDITIONS).astype(TRACK_CONDITION_DTYPE)
+        race_attrs = race_df[['race_key', 'track_type_code', 'track_condition']]
+        
+        keys = ['sire_id', 'sire_name', 'track_type_code', 'track_condition']
+        sire_ids = {}
+        sire_names = {}
+        acc = None
+        
+        result_columns = _RACE_KEY_COLUMNS + [
+            'ketto_toroku_bango', 'kakutei_chakujun', 'tansho_odds', 'tansho_ninkijun'
+        ]
+        for chunk in extract_horse_result_data(year_from, year_to, chunksize=chunksize, columns=result_columns):
+            add_race_key(chunk)
+            chunk = pd.merge(chunk, race_attrs, on='race_key')
+            
+            # 未取得の馬の血統データのみ取得
+            horse_ids = chunk['ketto_toroku_bango'].astype(str)
+            missing = [h for h in horse_ids.unique() if h not in sire_ids]
+            if missing:
+                pedigree_df = extract_horse_pedigree_data(missing, columns=_SIRE_PEDIGREE_COLUMNS)
+                # 血統データのない馬も再取得しないようNoneで登録しておく
+                sire_ids.update(dict.fromkeys(missing))
+                sire_names.update(dict.fromkeys(missing))
+                if not pedigree_df.empty:
+                    pedigree_ids = pedigree_df['ketto_toroku_bango'].astype(str)
+                    sire_ids.update(zip(pedigree_ids, pedigree_df['sire_id']))
+                    sire_names.update(zip(pedigree_ids, pedigree_df['sire_name']))
+            chunk['sire_id'] = horse_ids.map(sire_ids)
+            chunk['sire_name'] = horse_ids.map(sire_names)
+            
+            chunk['win'] = (pd.to_numeric(chunk['kakutei_chakujun'], errors='coerce') == 1).fillna(False).astype(int)
+            chunk['tansho_odds'] = pd.to_numeric(chunk['tansho_odds'], errors='coerce').astype('float64') / 10
+            chunk['tansho_ninkijun'] = pd.to_numeric(chunk['tansho_ninkijun'], errors='coerce').astype('float64')
+            chunk['win_odds_contrib'] = chunk['tansho_odds'].where(chunk['win'] == 1, 0.0)
+            
+            # チャンク内の部分集計（平均人気は合計と件数で持つ）
+            chunk_agg = chunk.groupby(keys, sort=False, observed=True).agg(
+                race_count=('race_key', 'count'),
+                win_count=('win', 'sum'),
+                win_odds_sum=('win_odds_contrib', 'sum'),
+                popularity_sum=('tansho_ninkijun', 'sum'),
+                popularity_count=('tansho_ninkijun', 'count')
+            )
+            acc = chunk_agg if acc is None else acc.add(chunk_agg, fill_value=0)
+        
+        if acc is None:
+            return pd.DataFrame()
+        
+        # 部分集計から率を計算（加算で浮動小数になった件数は整数に戻す）
+        acc = acc.astype({'race_count': 'int64', 'win_count': 'int64'})
+        acc['avg_popularity'] = acc['popularity_sum'] / acc['popularity_count']
+        roi_data = acc.drop(columns=['popularity_sum', 'popularity_count']).reset_index()
+        roi_data = _decode_track_type(roi_data)
+        roi_data = _add_rate_columns(roi_data, 'race_count')
         
         # サンプル数の少ないものを除外
         roi_data = roi_data[roi_data['race_count'] >= min_races]
         
         # 回収率でソート
-        roi_data = roi_data.sort_values('roi', ascending=False)
-        
-        return roi_data
+        return to_columnar(roi_data.sort_values('roi', ascending=False))
     
     except Exception as e:
         logger.error(f"種牡馬×馬場適性ROI計算中にエラーが発生しました: {e}")
         return pd.DataFrame()
 
-def calculate_jockey_course_odds(race_df, result_df, min_rides=10):
+def calculate_jockey_course_odds(race_df, result_df, min_rides=10, return_type='pandas'):
     """
     騎手のコース別平均配当を計算する関数
     
     各騎手が特定コースで勝利したときの平均配当を計算する
     
     Args:
-        race_df (DataFrame): レース基本情報のDataFrame
-        result_df (DataFrame): レース結果のDataFrame
+        race_df (DataFrame or polars.DataFrame): レース基本情報のDataFrame
+        result_df (DataFrame or polars.DataFrame): レース結果のDataFrame
         min_rides (int): 最低騎乗数の閾値
+        return_type (str): 'pandas'または'polars'
     
     Returns:
         DataFrame: 騎手のコース別平均配当のDataFrame
     """
     try:
-        # レースIDの作成
-        race_df['race_id'] = race_df['kaisai_nen'] + race_df['kaisai_tsukihi'] + race_df['keibajo_code'] + race_df['race_bango']
-        result_df['race_id'] = result_df['kaisai_nen'] + result_df['kaisai_tsukihi'] + result_df['keibajo_code'] + result_df['race_bango']
-        
         # データ結合
-        df = pd.merge(result_df, race_df, on='race_id', suffixes=('', '_race'))
-        
-        # 勝利フラグを追加
-        df['win'] = (df['kakutei_chakujun'] == '01').astype(int)
-        
-        # 競馬場名の変換
-        df['course_name'] = df['keibajo_code'].map({
-            '01': '札幌', '02': '函館', '03': '福島', '04': '新潟',
-            '05': '東京', '06': '中山', '07': '中京', '08': '京都',
-            '09': '阪神', '10': '小倉'
-        })
-        
-        # トラックタイプの判定
-        df['track_type'] = df['track_code'].apply(
-            lambda x: '芝' if str(x).startswith('1') else 'ダート' if str(x).startswith('2') else 'その他'
-        )
+        lf = _join_race_lazy(to_polars(race_df), to_polars(result_df), ['track_code', 'kyori'])
         
-        # 距離区分の作成
-        df['kyori'] = pd.to_numeric(df['kyori'], errors='coerce')
-        df['distance_category'] = pd.cut(
-            df['kyori'],
-            bins=[0, 1400, 2000, 10000],
-            labels=['短距離', '中距離', '長距離']
+        # 競馬場名・トラックタイプ・距離区分の判定
+        lf = lf.with_columns(
+            _label_expr('keibajo_code', _COURSE_NAMES, _COURSE_NAME_ENUM, 'course_name'),
+            _track_type_expr(),
+            _distance_category_expr()
         )
         
-        # 数値型への変換
-        df['tansho_odds'] = pd.to_numeric(df['tansho_odds'], errors='coerce') / 10
-        df['tansho_ninkijun'] = pd.to_numeric(df['tansho_ninkijun'], errors='coerce')
-        
         # 騎手×コース×距離区分のグループ集計
-        jockey_data = df.groupby([
-            'kishu_code', 'kishumei_ryakusho', 'course_name', 'track_type', 'distance_category'
-        ]).agg(
-            ride_count=('race_id', 'count'),
-            win_count=('win', 'sum'),
-            win_odds_sum=('tansho_odds', lambda x: df.loc[df['win'] == 1, 'tansho_odds'].sum()),
-            avg_popularity=('tansho_ninkijun', 'mean')
-        ).reset_index()
-        
-        # 勝率と回収率の計算
-        jockey_data['win_rate'] = jockey_data['win_count'] / jockey_data['ride_count'] * 100
-        jockey_data['roi'] = jockey_data['win_odds_sum'] / jockey_data['ride_count'] * 100
-        
-        # 平均勝利オッズの計算 (0除算回避)
-        jockey_data['avg_win_odds'] = jockey_data.apply(
-            lambda x: x['win_odds_sum'] / x['win_count'] if x['win_count'] > 0 else 0, 
-            axis=1
-        )
-        
-        # サンプル数の少ないものを除外
-        jockey_data = jockey_data[jockey_data['ride_count'] >= min_rides]
-        
-        # 回収率でソート
-        jockey_data = jockey_data.sort_values('roi', ascending=False)
-        
-        return jockey_data
+        return _to_output(_aggregate_roi(
+            lf, ['kishu_code', 'kishumei_ryakusho', 'course_name', 'track_type', 'distance_category'],
+            'ride_count', min_rides
+        ), return_type)
     
     except Exception as e:
         logger.error(f"騎手のコース別平均配当計算中にエラーが発生しました: {e}")
         return pd.DataFrame()
 
-def calculate_horse_course_roi(race_df, result_df, min_races=3):
+def calculate_horse_course_roi(race_df, result_df, min_races=3, return_type='pandas'):
     """
     馬のコース実績ROIを計算する関数
     
     各馬が特定コースでどれだけ回収率が高いかを計算する
     
     Args:
-        race_df (DataFrame): レース基本情報のDataFrame
-        result_df (DataFrame): レース結果のDataFrame
+        race_df (DataFrame or polars.DataFrame): レース基本情報のDataFrame
+        result_df (DataFrame or polars.DataFrame): レース結果のDataFrame
         min_races (int): 最低レース数の閾値
+        return_type (str): 'pandas'または'polars'
     
     Returns:
         DataFrame: 馬のコース実績ROIのDataFrame
     """
     try:
-        # レースIDの作成
-        race_df['race_id'] = race_df['kaisai_nen'] + race_df['kaisai_tsukihi'] + race_df['keibajo_code'] + race_df['race_bango']
-        result_df['race_id'] = result_df['kaisai_nen'] + result_df['kaisai_tsukihi'] + result_df['keibajo_code'] + result_df['race_bango']
-        
         # データ結合
-        df = pd.merge(result_df, race_df, on='race_id', suffixes=('', '_race'))
+        lf = _join_race_lazy(to_polars(race_df), to_polars(result_df), ['track_code', 'kyori'])
         
-        # 勝利フラグを追加
-        df['win'] = (df['kakutei_chakujun'] == '01').astype(int)
+        # 競馬場名・トラックタイプ・距離区分の判定
+        lf = lf.with_columns(
+            _label_expr('keibajo_code', _COURSE_NAMES, _COURSE_NAME_ENUM, 'course_name'),
+            _track_type_expr(),
+            _distance_category_expr()
+        )
         
-        # 競馬場名の変換
-        df['course_name'] = df['keibajo_code'].map({
-            '01': '札幌', '02': '函館', '03': '福島', '04': '新潟',
-            '05': '東京', '06': '中山', '07': '中京', '08': '京都',
-            '09': '阪神', '10': '小倉'
-        })
-        
-        # トラックタイプの判定
-        df['track_type'] = df['track_code'].apply(
-            lambda x: '芝' if str(x).startswith('1') else 'ダート' if str(x).startswith('2') else 'その他'
+        # 馬×コース×トラック×距離区分のグループ集計
+        horse_data = _aggregate_roi(
+            lf, ['ketto_toroku_bango', 'bamei', 'course_name', 'track_type', 'distance_category'],
+            'race_count', min_races
         )
         
-        # 距離区分の作成
-        df['kyori'] = pd.to_numeric(df['kyori'], errors='coerce')
-        df['distance_category'] = pd.cut(
-            df['kyori'],
-            bins=[0, 1400, 2000, 10000],
-            labels=['短距離', '中距離', '長距離']
+        # リピーターレベルの判定（_repeater_levelと同じ区切り）
+        win_rate = pl.col('win_rate')
+        horse_data = horse_data.with_columns(
+            pl.when(win_rate <= 10).then(pl.lit('WEAK_REPEATER'))
+            .when(win_rate <= 15).then(pl.lit('AVERAGE_REPEATER'))
+            .when(win_rate <= 25).then(pl.lit('GOOD_REPEATER'))
+            .otherwise(pl.lit('STRONG_REPEATER'))
+            .cast(_REPEATER_LEVEL_ENUM).alias('repeater_level')
         )
         
-        # 数値型への変換
-        df['tansho_odds'] = pd.to_numeric(df['tansho_odds'], errors='coerce') / 10
-        df['tansho_ninkijun'] = pd.to_numeric(df['tansho_ninkijun'], errors='coerce')
+        return _to_output(horse_data, return_type)
+    
+    except Exception as e:
+        logger.error(f"馬のコース実績ROI計算中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def calculate_sire_track_roi_from_db(year_from=2010, year_to=2023, min_races=20):
+    """
+    種牡馬×馬場適性ROIをデータベース側の集計から計算する関数
+    
+    calculate_sire_track_roiと同じ結果を、全出走データを取得せずに集計済みの行だけから計算する
+    
+    Args:
+        year_from (int): 集計開始年
+        year_to (int): 集計終了年
+        min_races (int): 最低レース数の閾値
+    
+    Returns:
+        DataFrame: 種牡馬×馬場適性ROIのDataFrame
+    """
+    try:
+        roi_data = extract_sire_track_agg(year_from, year_to, min_races)
+        if roi_data.empty:
+            return roi_data
         
-        # 馬×コース×トラック×距離区分のグループ集計
-        horse_data = df.groupby([
-            'ketto_toroku_bango', 'bamei', 'course_name', 'track_type', 'distance_category'
-        ]).agg(
-            race_count=('race_id', 'count'),
-            win_count=('win', 'sum'),
-            win_odds_sum=('tansho_odds', lambda x: df.loc[df['win'] == 1, 'tansho_odds'].sum()),
-            avg_popularity=('tansho_ninkijun', 'mean')
-        ).reset_index()
-        
-        # 勝率と回収率の計算
-        horse_data['win_rate'] = horse_data['win_count'] / horse_data['race_count'] * 100
-        horse_data['roi'] = horse_data['win_odds_sum'] / horse_data['race_count'] * 100
-        
-        # 平均勝利オッズの計算 (0除算回避)
-        horse_data['avg_win_odds'] = horse_data.apply(
-            lambda x: x['win_odds_sum'] / x['win_count'] if x['win_count'] > 0 else 0, 
-            axis=1
-        )
+        # 馬場状態の判定
+        roi_data['track_condition'] = roi_data['baba_jotai'].map(_TRACK_CONDITIONS).astype(TRACK_CONDITION_DTYPE)
+        roi_data = roi_data.dropna(subset=['sire_id', 'sire_name', 'track_condition'])
+        roi_data = roi_data[
+            ['sire_id', 'sire_name', 'track_type', 'track_condition',
+             'race_count', 'win_count', 'win_odds_sum', 'avg_popularity']
+        ].copy()
+        roi_data['track_type'] = roi_data['track_type'].astype(TRACK_TYPE_DTYPE)
         
-        # サンプル数の少ないものを除外
-        horse_data = horse_data[horse_data['race_count'] >= min_races]
+        # 勝率・回収率・平均勝利オッズの計算
+        roi_data = _add_rate_columns(roi_data, 'race_count')
         
-        # リピーターレベルの判定
-        horse_data['repeater_level'] = pd.cut(
-            horse_data['win_rate'],
-            bins=[-0.1, 10, 15, 25, 100],
-            labels=['WEAK_REPEATER', 'AVERAGE_REPEATER', 'GOOD_REPEATER', 'STRONG_REPEATER']
-        )
+        # 回収率でソート
+        return to_columnar(roi_data.sort_values('roi', ascending=False))
+    
+    except Exception as e:
+        logger.error(f"種牡馬×馬場適性ROI計算中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def calculate_jockey_course_odds_from_db(year_from=2010, year_to=2023, min_rides=10):
+    """
+    騎手のコース別平均配当をデータベース側の集計から計算する関数
+    
+    calculate_jockey_course_oddsと同じ結果を、全出走データを取得せずに集計済みの行だけから計算する
+    
+    Args:
+        year_from (int): 集計開始年
+        year_to (int): 集計終了年
+        min_rides (int): 最低騎乗数の閾値
+    
+    Returns:
+        DataFrame: 騎手のコース別平均配当のDataFrame
+    """
+    try:
+        jockey_data = extract_jockey_course_agg(year_from, year_to, min_rides)
+        if jockey_data.empty:
+            return jockey_data
+        
+        # 競馬場名の変換
+        jockey_data['course_name'] = jockey_data['keibajo_code'].map(_COURSE_NAMES).astype(COURSE_NAME_DTYPE)
+        jockey_data = jockey_data.dropna(subset=['kishu_code', 'kishumei_ryakusho', 'course_name', 'distance_category'])
+        jockey_data = jockey_data[
+            ['kishu_code', 'kishumei_ryakusho', 'course_name', 'track_type', 'distance_category',
+             'ride_count', 'win_count', 'win_odds_sum', 'avg_popularity']
+        ].copy()
+        jockey_data['track_type'] = jockey_data['track_type'].astype(TRACK_TYPE_DTYPE)
+        jockey_data['distance_category'] = jockey_data['distance_category'].astype(DISTANCE_CATEGORY_DTYPE)
+        
+        # 勝率・回収率・平均勝利オッズの計算
+        jockey_data = _add_rate_columns(jockey_data, 'ride_count')
         
         # 回収率でソート
-        horse_data = horse_data.sort_values('roi', ascending=False)
+        return to_columnar(jockey_data.sort_values('roi', ascending=False))
+    
+    except Exception as e:
+        logger.error(f"騎手のコース別平均配当計算中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def calculate_horse_course_roi_from_db(year_from=2010, year_to=2023, min_races=3):
+    """
+    馬のコース実績ROIをデータベース側の集計から計算する関数
+    
+    calculate_horse_course_roiと同じ結果を、全出走データを取得せずに集計済みの行だけから計算する
+    
+    Args:
+        year_from (int): 集計開始年
+        year_to (int): 集計終了年
+        min_races (int): 最低レース数の閾値
+    
+    Returns:
+        DataFrame: 馬のコース実績ROIのDataFrame
+    """
+    try:
+        horse_data = extract_horse_course_agg(year_from, year_to, min_races)
+        if horse_data.empty:
+            return horse_data
+        
+        # 競馬場名の変換
+        horse_data['course_name'] = horse_data['keibajo_code'].map(_COURSE_NAMES).astype(COURSE_NAME_DTYPE)
+        horse_data = horse_data.dropna(subset=['ketto_toroku_bango', 'bamei', 'course_name', 'distance_category'])
+        horse_data = horse_data[
+            ['ketto_toroku_bango', 'bamei', 'course_name', 'track_type', 'distance_category',
+             'race_count', 'win_count', 'win_odds_sum', 'avg_popularity']
+        ].copy()
+        horse_data['track_type'] = horse_data['track_type'].astype(TRACK_TYPE_DTYPE)
+        horse_data['distance_category'] = horse_data['distance_category'].astype(DISTANCE_CATEGORY_DTYPE)
+        
+        # 勝率・回収率・平均勝利オッズの計算
+        horse_data = _add_rate_columns(horse_data, 'race_count')
         
-        return horse_data
+        # リピーターレベルの判定
+        horse_data['repeater_level'] = _repeater_level(horse_data['win_rate'])
+        
+        # 回収率でソート
+        return to_columnar(horse_data.sort_values('roi', ascending=False))
     
     except Exception as e:
         logger.error(f"馬のコース実績ROI計算中にエラーが発生しました: {e}")